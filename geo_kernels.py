@@ -0,0 +1,218 @@
+"""
+geo_kernels.py — числовые ядра для треков: расстояния, длина трека, фильтр скачков, въезды.
+
+Работают с параллельными массивами: lat/lon в градусах (float64), tm_ns — время в наносекундах (int64).
+
+Если установлен numba, последовательный фильтр скачков и сумма расстояний компилируются @njit.
+Вместо numba модуль можно собрать mypyc (ускоряет Python-вариант фильтра):
+    python -m mypyc geo_kernels.py
+собранное расширение импортируется вместо geo_kernels.py (numba-ядра в нём отключаются),
+а без него работает обычный Python.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import Any, Tuple
+
+import numpy as np
+
+# numba необязателен: без него остаются NumPy/Python-варианты ядер
+try:
+    import numba as nb  # type: ignore
+except Exception:
+    nb = None  # type: ignore[assignment]
+
+R_KM = 6371.0
+
+
+# Шаги трека короткие (метры, редко километры) — для них равнопромежуточная проекция
+# совпадает с haversine до ~(d/R)^2 относительной (1e-8 на 1 км), а вместо
+# sin^2 + 2 cos + atan2 нужен один cos и один sqrt
+def equirect_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return R_KM * math.sqrt(x * x + y * y)
+
+
+def equirect_pairs(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    # Векторный equirect_km для соседних точек трека: len(lat) - 1 отрезков
+    x = np.radians(np.diff(lon)) * np.cos(np.radians((lat[:-1] + lat[1:]) * 0.5))
+    y = np.radians(np.diff(lat))
+    return R_KM * np.sqrt(x * x + y * y)
+
+
+_total_km_nb: Any = None
+_filter_jumps_nb: Any = None
+
+if nb is not None:
+    try:
+
+        @nb.njit(cache=True, fastmath=True)
+        def _eq_nb(lat1, lon1, lat2, lon2):
+            x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+            y = math.radians(lat2 - lat1)
+            return R_KM * math.sqrt(x * x + y * y)
+
+        # без parallel=True: запросы идут из потоков FastAPI, а потоковые слои numba
+        # (tbb/workqueue) при вызове не из главного потока виснут на выходе или небезопасны
+        @nb.njit(cache=True, fastmath=True)
+        def _total_km_nb(lat, lon):
+            s = 0.0
+            for i in range(1, lat.size):
+                s += _eq_nb(lat[i - 1], lon[i - 1], lat[i], lon[i])
+            return s
+
+        @nb.njit(cache=True, fastmath=True)
+        def _filter_jumps_nb(lat, lon, tm_s, max_jump_km, max_speed_kmh):
+            n = lat.size
+            keep = np.zeros(n, np.bool_)
+            keep[0] = True
+            removed = 0
+            prev_i = 0
+            for i in range(1, n):
+                d = _eq_nb(lat[prev_i], lon[prev_i], lat[i], lon[i])
+                ok = d <= max_jump_km
+                if ok:
+                    dt_s = tm_s[i] - tm_s[prev_i]
+                    if dt_s > 0 and d / (dt_s / 3600.0) > max_speed_kmh:
+                        ok = False
+                if ok:
+                    keep[i] = True
+                    prev_i = i
+                else:
+                    removed += 1
+            return keep, removed
+
+    except TypeError:
+        # модуль собран mypyc: функции уже нативные, numba их не принимает
+        _total_km_nb = None
+        _filter_jumps_nb = None
+    except Exception as e:
+        # например, cache=True без доступного на запись места под кэш (read-only каталог
+        # деплоя и нет домашнего) — numba необязателен, работаем на NumPy/Python-ядрах
+        print(f"[WARN] geo_kernels: numba-ядра отключены: {e}")
+        _total_km_nb = None
+        _filter_jumps_nb = None
+
+
+def total_km(lat: np.ndarray, lon: np.ndarray) -> float:
+    if len(lat) < 2:
+        return 0.0
+    if _total_km_nb is not None:
+        return float(_total_km_nb(lat, lon))
+    return float(equirect_pairs(lat, lon).sum())
+
+
+def segment_km(lat: np.ndarray, lon: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    """
+    Длины кусков трека [bounds[k], bounds[k+1]) за один проход: расстояния между соседями
+    считаются один раз, отрезок через границу кусков ни в один кусок не входит.
+    """
+    a = bounds[:-1]
+    b = bounds[1:]
+    if len(lat) < 2:
+        return np.zeros(len(a))
+    # cs[i] — путь от точки 0 до точки i
+    cs = np.concatenate(([0.0], np.cumsum(equirect_pairs(lat, lon))))
+    return cs[np.maximum(b - 1, a)] - cs[a]
+
+
+def _filter_jumps_py(
+    lat: np.ndarray,
+    lon: np.ndarray,
+    tm_ns: np.ndarray,
+    max_jump_km: float,
+    max_speed_kmh: float,
+) -> Tuple[np.ndarray, int]:
+    # Расстояния между соседями считаем разом; пока предыдущая точка не выброшена,
+    # prev совпадает с соседом и готовое значение из d подходит без пересчёта
+    n = len(lat)
+    d_pairs = equirect_pairs(lat, lon).tolist()
+    lat_l = lat.tolist()
+    lon_l = lon.tolist()
+    tm_l = tm_ns.tolist()
+
+    keep = np.zeros(n, dtype=np.bool_)
+    keep[0] = True
+    removed = 0
+    prev_i = 0
+
+    for i in range(1, n):
+        if prev_i == i - 1:
+            d = d_pairs[i - 1]
+        else:
+            d = equirect_km(lat_l[prev_i], lon_l[prev_i], lat_l[i], lon_l[i])
+
+        speed_ok = True
+        dt_s = (tm_l[i] - tm_l[prev_i]) / 1e9
+        if dt_s > 0:
+            sp = d / (dt_s / 3600.0)
+            if sp > max_speed_kmh:
+                speed_ok = False
+
+        if d <= max_jump_km and speed_ok:
+            keep[i] = True
+            prev_i = i
+        else:
+            removed += 1
+
+    return keep, removed
+
+
+def filter_jumps_sequential(
+    lat: np.ndarray,
+    lon: np.ndarray,
+    tm_ns: np.ndarray,
+    max_jump_km: float,
+    max_speed_kmh: float,
+) -> Tuple[np.ndarray, int]:
+    """
+    Каждая точка сравнивается с последней принятой. Возвращает (маска keep, сколько выброшено).
+    Ожидает len(lat) >= 1.
+    """
+    if _filter_jumps_nb is not None:
+        tm_s = (tm_ns - tm_ns[0]) / 1e9
+        keep, removed = _filter_jumps_nb(lat, lon, tm_s, max_jump_km, max_speed_kmh)
+        return keep, int(removed)
+    return _filter_jumps_py(lat, lon, tm_ns, max_jump_km, max_speed_kmh)
+
+
+def filter_jumps_neighbor(
+    lat: np.ndarray,
+    lon: np.ndarray,
+    tm_ns: np.ndarray,
+    max_jump_km: float,
+    max_speed_kmh: float,
+) -> Tuple[np.ndarray, int]:
+    """
+    Без последовательной зависимости: отрезок "плохой" по дальности/скорости между соседями,
+    точка — выброс, если плохие оба её отрезка (для последней — входящий). Ожидает len(lat) >= 2.
+    """
+    d = equirect_pairs(lat, lon)
+    dt_h = np.diff(tm_ns) / 3.6e12
+    pos = dt_h > 0
+    bad = (d > max_jump_km) | (pos & (d / np.where(pos, dt_h, 1.0) > max_speed_kmh))
+
+    drop = np.zeros(len(lat), dtype=np.bool_)
+    drop[1:-1] = bad[:-1] & bad[1:]
+    drop[-1] = bad[-1]
+    return ~drop, int(np.count_nonzero(drop))
+
+
+def warmup() -> None:
+    # Прогоняет ядра на крошечном треке: numba компилирует (или грузит из кэша) их
+    # при старте сервиса, а не на первом запросе
+    lat = np.array([55.0, 55.001, 55.002])
+    lon = np.array([37.0, 37.001, 37.002])
+    tm_ns = np.array([0, 10**9, 2 * 10**9], dtype=np.int64)
+    total_km(lat, lon)
+    filter_jumps_sequential(lat, lon, tm_ns, 1.0, 180.0)
+
+
+def entry_idxs(inside: np.ndarray) -> np.ndarray:
+    # въезд — переход снаружи внутрь; точка 0 внутри тоже считается въездом
+    idxs = np.flatnonzero(inside[1:] & ~inside[:-1]) + 1
+    if len(inside) and inside[0]:
+        idxs = np.concatenate(([0], idxs))
+    return idxs
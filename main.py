@@ -1,17 +1,28 @@
 from __future__ import annotations
 
+import hashlib
+import io
 import math
-import tempfile
-from datetime import datetime
+import threading
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Literal, Optional
 
+import numpy as np
 import openpyxl
-from fastapi import Body, FastAPI, Query
+import orjson
+from fastapi import Body, FastAPI, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 
+from geo_kernels import entry_idxs, filter_jumps_neighbor, filter_jumps_sequential, segment_km, total_km, warmup
+
 # Пытаемся импортировать модуль работы с Postgres; если его нет — используем безопасный заглушечный вариант
 try:
     import pgdb as _pgdb  # type: ignore
@@ -50,12 +61,40 @@ except Exception:
                 })
             return out
 
+        def get_form_json(self, form_id: int) -> Optional[Dict[str, Any]]:
+            doc = self._forms.get(form_id)
+            if not doc:
+                return None
+            return {
+                "id": doc["id"],
+                "created_at": doc.get("created_at"),
+                "payload_json": orjson.dumps(doc.get("payload") or {}).decode(),
+            }
+
+        def list_forms_json(self, limit: int = 50) -> List[Dict[str, Any]]:
+            out = []
+            for fid in sorted(self._forms.keys(), reverse=True)[:limit]:
+                doc = self._forms[fid]
+                payload = doc.get("payload") or {}
+                out.append({
+                    "id": fid,
+                    "created_at": doc.get("created_at"),
+                    "meta_json": orjson.dumps(payload.get("meta") or {}).decode(),
+                })
+            return out
+
         def fetch_oids(self, limit: int = 500) -> List[int]:
             return []
 
         def fetch_routes(self) -> List[Dict[str, Any]]:
             return []
 
+        def ensure_indexes(self) -> None:
+            pass
+
+        def close_pool(self) -> None:
+            pass
+
     pgdb = _PgdbStub()
 
 # -----------------------------
@@ -64,15 +103,55 @@ except Exception:
 BASE_DIR = Path(__file__).resolve().parent
 TEMPLATE_XLSX = BASE_DIR / "Камаз-маз.xlsx"
 
+# Сколько строк точек раскладывать в массивы за раз
+POINTS_FILL_BLOCK = 10_000
+
 # ---- Пескобаза (погрузка) ----
 SAND_BASE_LAT = 52.036242
 SAND_BASE_LON = 37.887744
 SAND_BASE_RADIUS_KM = 0.02  # 20 метров (0.02 км)
 
+# В радиусе десятков метров плоская (равнопромежуточная) проекция вокруг пескобазы
+# совпадает с haversine до долей миллиметра — сравниваем квадраты без тригонометрии
+KM_PER_DEG = math.pi * 6371.0 / 180.0
+SAND_BASE_LAT_RAD = math.radians(SAND_BASE_LAT)
+SAND_BASE_COS_LAT = math.cos(SAND_BASE_LAT_RAD)
+SAND_BASE_R2_DEG = (SAND_BASE_RADIUS_KM / KM_PER_DEG) ** 2
+# Полоса по широте с запасом 1%: точки вне неё заведомо снаружи, для них квадраты не считаем
+SAND_BASE_LAT_DEG_LIMIT = SAND_BASE_RADIUS_KM / KM_PER_DEG * 1.01
+
 # -----------------------------
 # App
 # -----------------------------
-app = FastAPI(title="Volovo Putevoy + Map + Trips + Postgres")
+class NumpyJSONResponse(JSONResponse):
+    # orjson: быстрее stdlib json и сам сериализует np.ndarray (C-contiguous) и numpy-скаляры
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def _ensure_pg_indexes() -> None:
+    try:
+        pgdb.ensure_indexes()
+    except Exception as e:
+        # база недоступна или нет прав — сервис работает и без индекса, просто медленнее
+        print(f"[WARN] ensure_indexes: {e}")
+
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    # JIT-компиляция ядер — до первого запроса
+    warmup()
+    # первое построение индекса на большой таблице долгое — старт сервиса его не ждёт
+    threading.Thread(target=_ensure_pg_indexes, daemon=True).start()
+    yield
+    pgdb.close_pool()
+
+
+app = FastAPI(
+    title="Volovo Putevoy + Map + Trips + Postgres",
+    default_response_class=NumpyJSONResponse,
+    lifespan=_lifespan,
+)
 
 # статические файлы бери из проекта, а не абсолютным /opt/...
 _putevoy_dir = BASE_DIR / "putevoy"
@@ -123,136 +202,208 @@ def fmt_tm(dt: datetime) -> str:
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
 
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+def _hav_from_sand(lat: float, lon: float) -> float:
+    # haversine от базы до точки; тригонометрия базы посчитана заранее
     R = 6371.0
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = (
-        math.sin(dlat / 2) ** 2
-        + math.cos(math.radians(lat1))
-        * math.cos(math.radians(lat2))
-        * math.sin(dlon / 2) ** 2
-    )
+    dlat = math.radians(lat) - SAND_BASE_LAT_RAD
+    dlon = math.radians(lon - SAND_BASE_LON)
+    a = math.sin(dlat / 2) ** 2 + SAND_BASE_COS_LAT * math.cos(math.radians(lat)) * math.sin(dlon / 2) ** 2
     return 2 * R * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
 
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _ns_to_dt(ns: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=ns // 1000)
+
+
+def _fmt_tm_ns(tm_ns: np.ndarray) -> List[str]:
+    # fmt_tm для целого массива разом: datetime-объекты на каждую точку не создаём
+    if not len(tm_ns):
+        return []
+    s = np.datetime_as_string(tm_ns.view("datetime64[ns]"), unit="s")
+    return np.char.replace(s, "T", " ").tolist()
+
+
+@dataclass
+class PointArr:
+    """
+    Точки трека в виде параллельных массивов (вместо списка dict на точку).
+    tm_ns — время в наносекундах от эпохи (int64), idx — индекс точки, -1 если не задан.
+    Срезы и маски (pa[a:b], pa[::step], pa[mask]) дают PointArr с видами/копиями колонок.
+    """
+
+    lat: np.ndarray
+    lon: np.ndarray
+    tm_ns: np.ndarray
+    idx: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def __getitem__(self, sel) -> "PointArr":
+        return PointArr(lat=self.lat[sel], lon=self.lon[sel], tm_ns=self.tm_ns[sel], idx=self.idx[sel])
+
+    def tm(self, i: int) -> str:
+        return fmt_tm(_ns_to_dt(int(self.tm_ns[i])))
+
+    def as_columns(self) -> Dict[str, Any]:
+        # Только для сериализации ответа: колонки уходят в orjson как есть
+        return {
+            "lat": np.ascontiguousarray(self.lat),
+            "lon": np.ascontiguousarray(self.lon),
+            "tm": _fmt_tm_ns(self.tm_ns),
+        }
+
+
+# строки fetch_points: (tm_us, lon, lat, idx)
+_ROW_TM, _ROW_LON, _ROW_LAT, _ROW_IDX = (itemgetter(i) for i in range(4))
+
+
 def iter_points_for_oid(
     oid: int,
     dt_from: Optional[str],
     dt_to: Optional[str],
     limit: int = 500_000,
-) -> List[Dict[str, Any]]:
+) -> PointArr:
     d1 = parse_tm(dt_from) if dt_from else None
     d2 = parse_tm(dt_to) if dt_to else None
 
-    rows = pgdb.fetch_points(oid, d1, d2, limit=limit)
-
-    pts: List[Dict[str, Any]] = []
-    for tm_dt, lon, lat, idx in rows:
-        if lat is None or lon is None:
-            continue
-        pts.append(
-            {
-                "lat": float(lat),
-                "lon": float(lon),
-                "tm": fmt_tm(tm_dt),
-                "tm_dt": tm_dt,
-                "idx": idx,
-                "dst": None,
-                "speed": None,
-            }
-        )
-    return pts
-
-
-def calc_total_km(points: List[Dict[str, Any]]) -> float:
-    if len(points) < 2:
-        return 0.0
-    s = 0.0
-    p0 = points[0]
-    for p in points[1:]:
-        s += haversine_km(p0["lat"], p0["lon"], p["lat"], p["lon"])
-        p0 = p
-    return s
-
-
-def calc_total_km_dst(points: List[Dict[str, Any]]) -> float:
+    rows = iter(pgdb.fetch_points(oid, d1, d2, limit=limit))
+
+    # строк не больше limit (LIMIT в SQL); np.empty не трогает память, пока в неё не пишут
+    lat = np.empty(limit, np.float64)
+    lon = np.empty(limit, np.float64)
+    tm_ns = np.empty(limit, np.int64)
+    idx_arr = np.empty(limit, np.int64)
+    n = 0
+    # заполняем блоками: колонка блока собирается одним map, а не поэлементной записью
+    while True:
+        block = list(islice(rows, POINTS_FILL_BLOCK))
+        if not block:
+            break
+        la = np.array(list(map(_ROW_LAT, block)), dtype=np.float64)  # None -> nan
+        lo = np.array(list(map(_ROW_LON, block)), dtype=np.float64)
+        tn = np.fromiter(map(_ROW_TM, block), np.int64, len(block)) * 1000
+        ix = np.array([-1 if i is None else i for i in map(_ROW_IDX, block)], dtype=np.int64)
+
+        ok = ~(np.isnan(la) | np.isnan(lo))
+        if not ok.all():
+            la, lo, tn, ix = la[ok], lo[ok], tn[ok], ix[ok]
+        k = len(la)
+        lat[n:n + k] = la
+        lon[n:n + k] = lo
+        tm_ns[n:n + k] = tn
+        idx_arr[n:n + k] = ix
+        n += k
+
+    return PointArr(lat=lat[:n], lon=lon[:n], tm_ns=tm_ns[:n], idx=idx_arr[:n])
+
+
+def calc_total_km(points: PointArr) -> float:
+    return total_km(points.lat, points.lon)
+
+
+def calc_total_km_dst(points: PointArr) -> float:
     return calc_total_km(points)
 
 
-def gps_filter_jumps(points: List[Dict[str, Any]], max_jump_km: float = 1.0, max_speed_kmh: float = 180.0):
+def gps_filter_jumps(
+    points: PointArr,
+    max_jump_km: float = 1.0,
+    max_speed_kmh: float = 180.0,
+    sequential: bool = True,
+):
+    """
+    sequential=True — каждая точка сравнивается с последней принятой (исходная логика);
+    sequential=False — векторная проверка по соседям, убирает одиночные выбросы.
+    """
     n = len(points)
     if n < 2:
         return points, {"original": n, "kept": n, "removed": 0}
 
-    kept = [points[0]]
-    removed = 0
-    prev = points[0]
-
-    for p in points[1:]:
-        d = haversine_km(prev["lat"], prev["lon"], p["lat"], p["lon"])
-
-        speed_ok = True
-        t1 = prev.get("tm_dt")
-        t2 = p.get("tm_dt")
-        if t1 and t2:
-            dt_s = (t2 - t1).total_seconds()
-            if dt_s > 0:
-                sp = d / (dt_s / 3600.0)
-                if sp > max_speed_kmh:
-                    speed_ok = False
-
-        if d <= max_jump_km and speed_ok:
-            kept.append(p)
-            prev = p
-        else:
-            removed += 1
+    flt = filter_jumps_sequential if sequential else filter_jumps_neighbor
+    keep, removed = flt(points.lat, points.lon, points.tm_ns, max_jump_km, max_speed_kmh)
 
+    kept = points[keep]
     return kept, {"original": n, "kept": len(kept), "removed": removed}
 
 
-def count_sand_base_entries(points: List[Dict[str, Any]]) -> int:
-    inside_prev = False
-    entries = 0
-    for p in points:
-        d = haversine_km(SAND_BASE_LAT, SAND_BASE_LON, p["lat"], p["lon"])
-        inside = d <= SAND_BASE_RADIUS_KM
-        if inside and not inside_prev:
-            entries += 1
-        inside_prev = inside
-    return entries
+def _sand_base_inside(points: PointArr) -> np.ndarray:
+    inside = np.zeros(len(points), dtype=np.bool_)
+    # почти все точки трека далеко от базы — отсекаем их одним сравнением по широте
+    cand = np.flatnonzero(np.abs(points.lat - SAND_BASE_LAT) <= SAND_BASE_LAT_DEG_LIMIT)
+    if not len(cand):
+        return inside
+
+    lat = points.lat[cand]
+    lon = points.lon[cand]
+    dy = lat - SAND_BASE_LAT
+    dx = (lon - SAND_BASE_LON) * SAND_BASE_COS_LAT
+    d2 = dy * dy + dx * dx
+    inside[cand] = d2 <= SAND_BASE_R2_DEG
+
+    # у самой границы круга проекция может разойтись с haversine — такие (единичные) точки
+    # перепроверяем точной формулой
+    edge = np.flatnonzero(np.abs(d2 - SAND_BASE_R2_DEG) <= SAND_BASE_R2_DEG * 1e-4)
+    for j in edge.tolist():
+        inside[cand[j]] = _hav_from_sand(float(lat[j]), float(lon[j])) <= SAND_BASE_RADIUS_KM
+    return inside
 
 
-def split_trips_from_sand_base(points: List[Dict[str, Any]]):
-    trips: List[List[Dict[str, Any]]] = []
-    cur: List[Dict[str, Any]] = []
-    inside_prev = False
-    entry_idxs = []
+def _sand_base_entry_idxs(points: PointArr) -> np.ndarray:
+    return entry_idxs(_sand_base_inside(points))
 
-    for i, p in enumerate(points):
-        d = haversine_km(SAND_BASE_LAT, SAND_BASE_LON, p["lat"], p["lon"])
-        inside = d <= SAND_BASE_RADIUS_KM
 
-        if inside and not inside_prev:
-            entry_idxs.append(i)
-            if cur:
-                trips.append(cur)
-                cur = []
-        cur.append(p)
-        inside_prev = inside
+def count_sand_base_entries(points: PointArr) -> int:
+    return len(_sand_base_entry_idxs(points))
 
-    if cur:
-        trips.append(cur)
 
-    return trips, entry_idxs
+def split_trips_from_sand_base(points: PointArr):
+    n = len(points)
+    if not n:
+        return [], []
+
+    # рейсы — непрерывные срезы между соседними въездами (виды на массивы, без копий)
+    entry_idxs = _sand_base_entry_idxs(points)
+    bounds = np.concatenate(([0], entry_idxs[entry_idxs > 0], [n])).tolist()
+    trips = [points[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    return trips, entry_idxs.tolist()
 
 
-def slim_points(points: List[Dict[str, Any]], max_points: int = 4000):
+def trips_km(points: PointArr, trips: List[PointArr]) -> np.ndarray:
+    # км каждого рейса (то же, что calc_total_km(tr)) одним проходом по всему треку;
+    # рейсы — подряд идущие срезы points, их границы восстанавливаем по длинам
+    bounds = np.cumsum([0] + [len(tr) for tr in trips])
+    return segment_km(points.lat, points.lon, bounds)
+
+
+def slim_points(points: PointArr, max_points: int = 4000, legacy: bool = False):
+    """
+    Равномерно прореживает трек до max_points точек; первая и последняя точки сохраняются.
+    Возвращает (точки, шаг) — шаг дробный, (n - 1) / (max_points - 1).
+    legacy=True — старое прореживание срезом [::step] (шаг целый, округлён вверх;
+    последняя точка дописывается, если в срез не попала).
+    """
     n = len(points)
     if n <= max_points:
         return points, 1
-    step = max(1, n // max_points)
-    return points[::step], step
+    if legacy:
+        # n // max_points при n чуть больше max_points даёт шаг 1 — без прореживания
+        step = -(-n // max_points)
+        if (n - 1) % step == 0:
+            return points[::step], step
+        # конец проверяем по индексу, а не сравнением точек
+        return points[np.r_[0:n:step, n - 1]], step
+    # при n > max_points индексы linspace строго возрастают — повторов нет
+    idx = np.linspace(0, n - 1, max_points).astype(np.int64)
+    return points[idx], (n - 1) / (max_points - 1)
+
+
+_ROW_KEYS = ("route", "tripNo", "km", "tons", "width", "length", "pssTonnage", "delivery")
+_TOTALS_KEYS = ("km_spread", "tons_sum", "km_gps", "delivery", "idle")
 
 
 def _sanitize_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
@@ -266,37 +417,26 @@ def _sanitize_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
         "dt_to": meta.get("dt_to") or "",
     }
 
-    rows_out = []
-    for r in rows:
-        rr = r or {}
-        rows_out.append(
-            {
-                "route": rr.get("route") or "",
-                "tripNo": rr.get("tripNo") or "",
-                "km": rr.get("km") or "",
-                "tons": rr.get("tons") or "",
-                "width": rr.get("width") or "",
-                "length": rr.get("length") or "",
-                "pssTonnage": rr.get("pssTonnage") or "",
-                "delivery": rr.get("delivery") or "",
-            }
-        )
-
-    totals_out = {
-        "km_spread": totals.get("km_spread") or "",
-        "tons_sum": totals.get("tons_sum") or "",
-        "km_gps": totals.get("km_gps") or "",
-        "delivery": totals.get("delivery") or "",
-        "idle": totals.get("idle") or "",
-    }
+    rows_out = [
+        {k: (r.get(k) or "") for k in _ROW_KEYS} if r else dict.fromkeys(_ROW_KEYS, "")
+        for r in rows
+    ]
+    totals_out = {k: (totals.get(k) or "") for k in _TOTALS_KEYS}
 
     return {"meta": meta_out, "rows": rows_out, "totals": totals_out}
 
 
-def fill_putevoy_xlsx(payload: Dict[str, Any], template_path: Path) -> str:
-    if template_path.exists():
-        wb = openpyxl.load_workbook(template_path)
-    else:
+@lru_cache(maxsize=4)
+def _template_bytes(template_path: Path) -> bytes:
+    # Шаблон не меняется — читаем файл один раз, дальше парсим из памяти.
+    # FileNotFoundError не кэшируется: появившийся позже шаблон подхватится.
+    return template_path.read_bytes()
+
+
+def fill_putevoy_xlsx(payload: Dict[str, Any], template_path: Path) -> bytes:
+    try:
+        wb = openpyxl.load_workbook(io.BytesIO(_template_bytes(template_path)))
+    except FileNotFoundError:
         wb = openpyxl.Workbook()
     ws = wb.active
 
@@ -307,10 +447,10 @@ def fill_putevoy_xlsx(payload: Dict[str, Any], template_path: Path) -> str:
     ws["AF20"] = totals.get("delivery") or ""
     ws["AF21"] = totals.get("idle") or ""
 
-    out = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
-    out.close()
-    wb.save(out.name)
-    return out.name
+    # собираем книгу в памяти: без временного файла, который потом читается обратно и остаётся в /tmp
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
 
 
 # -----------------------------
@@ -329,36 +469,75 @@ def save_form(payload: Dict[str, Any] = Body(...)):
     return {"status": "ok", "form_id": str(new_id)}
 
 
+def _iso_s(dt: Optional[datetime]) -> str:
+    return dt.isoformat(timespec="seconds") if dt else ""
+
+
+def _json_merge(head: Dict[str, Any], obj_json: str) -> bytes:
+    """
+    {**head, **obj} в виде JSON-байтов, где obj уже лежит JSON-текстом (из базы):
+    дописываем его поля после head, не разбирая. При совпадении ключей парсер
+    на клиенте берёт последнее значение — как и при распаковке dict.
+    """
+    head_b = orjson.dumps(head)
+    body = obj_json.strip()
+    if body in ("", "{}", "null"):
+        return head_b
+    return head_b[:-1] + b"," + body[1:].encode()
+
+
+# Сохранённые формы не редактируются — готовый ответ/payload по id можно держать в памяти.
+# Промах (нет формы) бросает KeyError, поэтому в кэш не попадает: форма может появиться позже.
+@lru_cache(maxsize=512)
+def _form_json_cached(form_id: int) -> bytes:
+    doc = pgdb.get_form_json(form_id)
+    if not doc:
+        raise KeyError(form_id)
+    head = {
+        "form_id": str(doc.get("id") or form_id),
+        "created_at": _iso_s(doc.get("created_at")),
+    }
+    return _json_merge(head, doc["payload_json"])
+
+
+@lru_cache(maxsize=512)
+def _form_payload_cached(form_id: int) -> Dict[str, Any]:
+    doc = pgdb.get_form(form_id)
+    if not doc:
+        raise KeyError(form_id)
+    return doc.get("payload") or {}
+
+
 @app.get("/api/forms/{form_id}")
 def get_form(form_id: str):
     if not form_id.isdigit():
         return JSONResponse({"error": "bad form_id"}, status_code=400)
 
-    doc = pgdb.get_form(int(form_id))
-    if not doc:
+    try:
+        body = _form_json_cached(int(form_id))
+    except KeyError:
         return JSONResponse({"error": "not found"}, status_code=404)
-
-    payload = doc.get("payload") or {}
-    return {
-        "form_id": str(doc.get("id") or form_id),
-        "created_at": (doc.get("created_at").isoformat(timespec="seconds") if doc.get("created_at") else ""),
-        **payload,
-    }
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/api/forms")
-def list_forms(limit: int = Query(50, ge=1, le=500)):
-    forms = pgdb.list_forms(limit=limit)
-    out = []
-    for f in forms:
-        out.append(
-            {
-                "form_id": f.get("form_id"),
-                "created_at": f.get("created_at").isoformat(timespec="seconds") if f.get("created_at") else "",
-                "meta": f.get("meta") or {},
-            }
+def list_forms(request: Request, limit: int = Query(50, ge=1, le=500)):
+    forms = pgdb.list_forms_json(limit=limit)
+    items = [
+        _json_merge(
+            {"form_id": str(f["id"]), "created_at": _iso_s(f.get("created_at"))},
+            '{"meta":' + (f.get("meta_json") or "{}") + "}",
         )
-    return {"forms": out}
+        for f in forms
+    ]
+    body = b'{"forms":[' + b",".join(items) + b"]}"
+
+    # список меняется только при сохранении новой формы — браузер может переиспользовать свой
+    etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @app.get("/api/forms/{form_id}/export_xlsx")
@@ -366,16 +545,15 @@ def export_xlsx_from_db(form_id: str):
     if not form_id.isdigit():
         return JSONResponse({"error": "bad form_id"}, status_code=400)
 
-    doc = pgdb.get_form(int(form_id))
-    if not doc:
+    try:
+        payload = _form_payload_cached(int(form_id))
+    except KeyError:
         return JSONResponse({"error": "not found"}, status_code=404)
 
-    payload = doc.get("payload") or {}
-    out_path = fill_putevoy_xlsx(payload, TEMPLATE_XLSX)
-    return FileResponse(
-        out_path,
+    return Response(
+        content=fill_putevoy_xlsx(payload, TEMPLATE_XLSX),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        filename=f"putevoy-{form_id}.xlsx",
+        headers={"Content-Disposition": f'attachment; filename="putevoy-{form_id}.xlsx"'},
     )
 
 
@@ -397,16 +575,23 @@ def points_summary(
     dt_to: Optional[str] = Query(None),
     max_jump_km: float = Query(1.0, ge=0.0, le=50.0),
     max_speed_kmh: float = Query(180.0, ge=1.0, le=400.0),
+    jump_mode: Literal["sequential", "neighbor"] = Query("sequential"),
 ):
     pts = iter_points_for_oid(oid, dt_from, dt_to)
 
     km_dst = calc_total_km_dst(pts)
-    pts_f, jump_stats = gps_filter_jumps(pts, max_jump_km=max_jump_km, max_speed_kmh=max_speed_kmh)
+    pts_f, jump_stats = gps_filter_jumps(
+        pts,
+        max_jump_km=max_jump_km,
+        max_speed_kmh=max_speed_kmh,
+        sequential=(jump_mode == "sequential"),
+    )
     km_hav = calc_total_km(pts_f)
 
-    entries = count_sand_base_entries(pts_f)
+    # въезды уже найдены при разбиении на рейсы — второй проход по точкам не нужен
     trips, entry_idxs = split_trips_from_sand_base(pts_f)
-    trips_km_filtered = [tr for tr in trips if calc_total_km(tr) >= 1.0]
+    entries = len(entry_idxs)
+    trips_filtered = int(np.count_nonzero(trips_km(pts_f, trips) >= 1.0))
 
     return {
         "oid": oid,
@@ -419,7 +604,7 @@ def points_summary(
         "km_haversine": round(km_hav, 3),
         "sand_base_entries": entries,
         "trips_total": len(trips),
-        "trips_filtered": len(trips_km_filtered),
+        "trips_filtered": trips_filtered,
     }
 
 
@@ -429,38 +614,47 @@ def trips_for_map(
     dt_from: Optional[str] = Query(None),
     dt_to: Optional[str] = Query(None),
     max_points: int = Query(4000, ge=200, le=20000),
+    jump_mode: Literal["sequential", "neighbor"] = Query("sequential"),
 ):
+    """
+    Рейсы для карты. Точки рейса отдаются колонками:
+    "points": {"lat": [...], "lon": [...], "tm": [...]} — i-я точка это (lat[i], lon[i], tm[i]).
+    """
     pts = iter_points_for_oid(oid, dt_from, dt_to)
-    pts_f, jump_stats = gps_filter_jumps(pts)
+    pts_f, jump_stats = gps_filter_jumps(pts, sequential=(jump_mode == "sequential"))
     trips, entry_idxs = split_trips_from_sand_base(pts_f)
+    kms = trips_km(pts_f, trips).tolist()
 
     out_trips = []
     for i, tr in enumerate(trips):
         tr_slim, step = slim_points(tr, max_points=max_points)
-        dist_hav = calc_total_km(tr)
-        dist_dst = calc_total_km_dst(tr)
+        # km_dst пока считается тем же haversine (см. calc_total_km_dst)
+        dist_hav = dist_dst = kms[i]
         out_trips.append(
             {
                 "i": i + 1,
-                "points": [{"lat": p["lat"], "lon": p["lon"], "tm": p["tm"]} for p in tr_slim],
+                "points": tr_slim.as_columns(),
                 "points_cnt": len(tr),
-                "slim_step": step,
+                "slim_step": round(step, 3),
                 "km_haversine": round(dist_hav, 3),
                 "km_dst": round(dist_dst, 3),
-                "tm_from": tr[0].get("tm") if tr else None,
-                "tm_to": tr[-1].get("tm") if tr else None,
+                "tm_from": tr.tm(0) if len(tr) else None,
+                "tm_to": tr.tm(-1) if len(tr) else None,
             }
         )
 
-    return {
-        "oid": oid,
-        "tm_from": dt_from,
-        "tm_to": dt_to,
-        "points_cnt": len(pts),
-        "points_cnt_filtered": len(pts_f),
-        "jump_filter": jump_stats,
-        "trips": out_trips,
-    }
+    # ответ с массивами отдаём сразу в orjson, минуя jsonable_encoder
+    return NumpyJSONResponse(
+        {
+            "oid": oid,
+            "tm_from": dt_from,
+            "tm_to": dt_to,
+            "points_cnt": len(pts),
+            "points_cnt_filtered": len(pts_f),
+            "jump_filter": jump_stats,
+            "trips": out_trips,
+        }
+    )
 
 
 # -----------------------------
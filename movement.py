@@ -13,7 +13,9 @@ movement.py — загрузка треков из Wialon-подобного и
 Особенности этой версии:
 - chunking по времени (по умолчанию 6 часов)
 - sync_state хранится по каждому oid: _id = f"{STATE_ID}:{oid}"
-- upsert ключ точек: (oid, tm)  -> стабильно при перезагрузке
+- ключ точек: (oid, tm), уникальный индекс uniq_oid_tm -> стабильно при перезагрузке;
+  по умолчанию новые точки вставляются (уже загруженные отсекает индекс),
+  с --upsert — upsert по (oid, tm) с перезаписью полей
 - track_key общий на весь запуск: f"{oid}|{RUN_FROM}|{RUN_TO}"
 """
 
@@ -21,17 +23,27 @@ from __future__ import annotations
 
 import os
 import re
-import json
 import time
 import argparse
-from dataclasses import dataclass
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, Tuple
-from urllib.parse import quote, urljoin
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import quote, urlencode, urljoin
 
 import requests
-from pymongo import MongoClient, UpdateOne, ASCENDING
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson необязателен: без него ответы API разбирает стандартный json
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None  # type: ignore[assignment]
+from pymongo import MongoClient, InsertOne, UpdateOne, ASCENDING
 from pymongo.errors import BulkWriteError
 
 
@@ -51,6 +63,14 @@ MONGO_URI = os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017").strip()
 DB_NAME = os.getenv("DB_NAME", "volovo").strip()
 COL_POINTS = os.getenv("COL_POINTS", "track_points").strip()
 
+# Размер одного bulk_write (ops за раз) — ограничивает память и размер BSON-батча
+BULK_SLAB = int(os.getenv("BULK_SLAB", "10000").strip() or "10000")
+# Сколько раз пробовать записать операции, упавшие не из-за дубликата
+BULK_ATTEMPTS = int(os.getenv("BULK_ATTEMPTS", "3").strip() or "3")
+# Потолок соединений к Mongo (пишут потоки oid + sync_state) и таймаут сокета, мс
+MONGO_MAX_POOL = int(os.getenv("MONGO_MAX_POOL", "32").strip() or "32")
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "60000").strip() or "60000")
+
 STATE_COL = os.getenv("STATE_COL", "sync_state").strip()
 STATE_ID = os.getenv("STATE_ID", "track_points_sync").strip()
 
@@ -63,6 +83,10 @@ HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60").strip() or "60")
 HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3").strip() or "3")
 HTTP_RETRY_SLEEP = float(os.getenv("HTTP_RETRY_SLEEP", "2").strip() or "2")
 REQUEST_SLEEP = float(os.getenv("REQUEST_SLEEP", "0").strip() or "0")
+# Сколько чанков одного oid качать параллельно (общий пул загрузки — FETCH_WORKERS на каждый из OID_WORKERS)
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8").strip() or "8")
+# Сколько oid обрабатывать параллельно
+OID_WORKERS = int(os.getenv("OID_WORKERS", "4").strip() or "4")
 
 # Отладка
 DEBUG = os.getenv("DEBUG", "0").strip().lower() in ("1", "true", "yes", "y")
@@ -76,15 +100,28 @@ def now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
 
+_RE_MS = re.compile(r"\.\d+.*$")
+_RE_TZ = re.compile(r"(Z|[+-]\d{2}:?\d{2})$")
+
+
 def parse_dt(s: str) -> datetime:
     """
     Ожидаемый формат системы: "YYYY-MM-DD HH:MM:SS"
     (как у тебя в запросах).
     """
-    s = s.strip().replace("T", " ")
+    s = s.strip()
+    # быстрый путь: уже ровно "YYYY-MM-DD HH:MM:SS" (или с "T") — fromisoformat на C,
+    # без regex и strptime; ошибки (кривые числа) отдаём старому пути
+    if len(s) == 19 and s[4] == "-" and s[7] == "-" and s[10] in " T" and s[13] == ":" and s[16] == ":":
+        try:
+            return datetime.fromisoformat(s)
+        except ValueError:
+            pass
+
+    s = s.replace("T", " ")
     # убрать миллисекунды/таймзоны если вдруг есть
-    s = re.sub(r"\.\d+.*$", "", s)
-    s = re.sub(r"(Z|[+-]\d{2}:?\d{2})$", "", s).strip()
+    s = _RE_MS.sub("", s)
+    s = _RE_TZ.sub("", s).strip()
     return datetime.strptime(s, "%Y-%m-%d %H:%M:%S")
 
 
@@ -127,8 +164,23 @@ def parse_oids(s: str) -> List[int]:
 
 
 def _to_float(x: Any) -> Optional[float]:
+    if x is None:
+        return None
+    # частые типы — без исключений как управляющей логики
+    t = type(x)
+    if t is float:
+        return x
+    if t is int:
+        return float(x)
+    if t is str:
+        if x == "":
+            return None
+        try:
+            return float(x.replace(",", "."))
+        except ValueError:
+            return None
     try:
-        if x is None or x == "":
+        if x == "":
             return None
         return float(x)
     except Exception:
@@ -138,19 +190,32 @@ def _to_float(x: Any) -> Optional[float]:
             return None
 
 
-def _hidden(html: str, name: str) -> Optional[str]:
-    m = re.search(
-        rf'<input[^>]+name="{re.escape(name)}"[^>]+value="([^"]*)"',
-        html,
-        flags=re.I,
-    )
-    return m.group(1) if m else None
+# скрытые поля ASP.NET-формы логина — все три за один проход по странице
+_HIDDEN_RE = re.compile(
+    r'<input[^>]+name="(__VIEWSTATE|__EVENTVALIDATION|__VIEWSTATEGENERATOR)"[^>]+value="([^"]*)"',
+    flags=re.I,
+)
+
+
+def _hidden_fields(html: str) -> Dict[str, str]:
+    fields: Dict[str, str] = {}
+    for name, value in _HIDDEN_RE.findall(html):
+        # как и при поиске по одному полю — берём первое вхождение
+        fields.setdefault(name, value)
+    return fields
 
 
 def cookie_line_from_jar(jar: requests.cookies.RequestsCookieJar) -> str:
     return "; ".join([f"{c.name}={c.value}" for c in jar])
 
 
+def cookie_line_to_jar(cookie_line: str, jar: requests.cookies.RequestsCookieJar) -> None:
+    for part in cookie_line.split(";"):
+        name, _, value = part.strip().partition("=")
+        if name:
+            jar.set(name, value)
+
+
 def load_cookie_line() -> Optional[str]:
     try:
         s = COOKIE_PATH.read_text(encoding="utf-8").strip()
@@ -172,13 +237,17 @@ def login_and_get_cookie_line(session: requests.Session) -> str:
     """
     Логин по схеме из твоего ноутбука. Возвращает строку cookie "a=b; c=d".
     """
+    # старые (протухшие) cookie не должны смешиваться с новыми
+    session.cookies.clear()
+
     r1 = session.get(f"{BASE}/login.aspx", timeout=HTTP_TIMEOUT)
     r1.raise_for_status()
     html = r1.text
 
-    viewstate = _hidden(html, "__VIEWSTATE")
-    eventvalidation = _hidden(html, "__EVENTVALIDATION")
-    viewstategenerator = _hidden(html, "__VIEWSTATEGENERATOR")
+    hidden = _hidden_fields(html)
+    viewstate = hidden.get("__VIEWSTATE")
+    eventvalidation = hidden.get("__EVENTVALIDATION")
+    viewstategenerator = hidden.get("__VIEWSTATEGENERATOR")
 
     if not viewstate:
         raise RuntimeError("Не нашёл __VIEWSTATE на login.aspx (форма изменилась?)")
@@ -206,7 +275,6 @@ def login_and_get_cookie_line(session: requests.Session) -> str:
             "Origin": BASE,
             "Referer": f"{BASE}/login.aspx",
             "Content-Type": "application/x-www-form-urlencoded",
-            "User-Agent": "Mozilla/5.0",
         },
         allow_redirects=False,
         timeout=HTTP_TIMEOUT,
@@ -235,17 +303,20 @@ def login_and_get_cookie_line(session: requests.Session) -> str:
 def ensure_cookie_line(session: requests.Session, cookie_line: Optional[str]) -> str:
     """
     Если cookie нет или она протухла — перелогиниваемся.
+    Cookie живут в session.cookies и уходят с каждым запросом сессии.
     """
     if not cookie_line:
         if DEBUG:
             print("[DEBUG] cookie отсутствуют — логинюсь")
         return login_and_get_cookie_line(session)
 
+    if not session.cookies:
+        cookie_line_to_jar(cookie_line, session.cookies)
+
     # Быстрый тест: открываем страницу отчёта (часто требует авторизацию)
     try:
         r = session.get(
             f"{BASE}/MileageReportData.aspx",
-            headers={"Cookie": cookie_line, "User-Agent": "Mozilla/5.0"},
             timeout=HTTP_TIMEOUT,
             allow_redirects=False,
         )
@@ -262,60 +333,285 @@ def ensure_cookie_line(session: requests.Session, cookie_line: Optional[str]) ->
         return login_and_get_cookie_line(session)
 
 
-def http_get_retry(url: str, headers: Dict[str, str]) -> requests.Response:
-    last_err: Optional[Exception] = None
-    for attempt in range(1, HTTP_RETRIES + 1):
-        try:
-            r = requests.get(url, headers=headers, timeout=HTTP_TIMEOUT)
-            r.raise_for_status()
-            return r
-        except Exception as e:
-            last_err = e
-            if attempt < HTTP_RETRIES:
-                time.sleep(HTTP_RETRY_SLEEP)
-            else:
-                raise
-    raise last_err  # type: ignore
+_PRINT_LOCK = threading.Lock()
+# проверка/перелогин — по одному: остальные потоки потом берут уже свежую cookie
+_COOKIE_LOCK = threading.Lock()
+# актуальная строка cookie на весь процесс (то же, что в COOKIE_PATH)
+_COOKIE_LINE: Optional[str] = None
+# у каждого потока своя requests.Session: Session не потокобезопасна (cookie jar, редиректы)
+_TLS = threading.local()
 
 
-def fetch_track(cookie_line: str, oid: int, dt_from: str, dt_to: str) -> Dict[str, Any]:
+def log(msg: str) -> None:
+    # oid обрабатываются в нескольких потоках — не даём строкам перемешиваться
+    with _PRINT_LOCK:
+        print(msg)
+
+
+def make_session() -> requests.Session:
+    """
+    Сессия с keep-alive и пулом соединений вместо нового TCP на каждый чанк,
+    повторы GET (ошибки соединения и 429/502/503/504) делает urllib3.
+    """
+    session = requests.Session()
+    session.headers.update({"User-Agent": "Mozilla/5.0"})
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=max(16, FETCH_WORKERS * OID_WORKERS),
+        max_retries=Retry(
+            total=max(0, HTTP_RETRIES - 1),
+            backoff_factor=HTTP_RETRY_SLEEP,
+            # 429 — трекер просит притормозить: urllib3 ждёт по Retry-After, иначе по backoff
+            status_forcelist=(429, 502, 503, 504),
+            # повторяем только GET: POST логина неидемпотентен
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def thread_session() -> requests.Session:
+    """
+    Сессия текущего потока (создаётся при первом вызове).
+    Если другой поток перелогинился, подкладывает в неё новую cookie.
+    """
+    session = getattr(_TLS, "session", None)
+    if session is None:
+        session = _TLS.session = make_session()
+        _TLS.cookie_line = None
+    line = _COOKIE_LINE
+    if line and _TLS.cookie_line != line:
+        session.cookies.clear()
+        cookie_line_to_jar(line, session.cookies)
+        _TLS.cookie_line = line
+    return session
+
+
+def refresh_cookie_line(stale: Optional[str]) -> str:
+    """
+    Перелогин после NoAuth. stale — cookie, с которой пришёл отказ: если другой поток
+    уже успел перелогиниться, берём его cookie, а не логинимся ещё раз.
+    """
+    global _COOKIE_LINE
+    with _COOKIE_LOCK:
+        if _COOKIE_LINE and _COOKIE_LINE != stale:
+            return _COOKIE_LINE
+        if DEBUG:
+            log("[DEBUG] NoAuth — перелогинюсь")
+        _COOKIE_LINE = _TLS.cookie_line = login_and_get_cookie_line(thread_session())
+        return _COOKIE_LINE
+
+
+def check_cookie_line() -> str:
+    """
+    ensure_cookie_line для общей cookie: проверка и перелогин под замком,
+    новая строка становится видна всем потокам через thread_session().
+    """
+    global _COOKIE_LINE
+    with _COOKIE_LOCK:
+        session = thread_session()
+        _COOKIE_LINE = _TLS.cookie_line = ensure_cookie_line(session, _COOKIE_LINE)
+        return _COOKIE_LINE
+
+
+class RateLimiter:
+    """
+    Общий для всех потоков темп запросов: старты не чаще одного в interval секунд.
+    interval <= 0 — без ограничения.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+# REQUEST_SLEEP — минимальный интервал между запросами к трекеру (на весь процесс)
+_RATE = RateLimiter(REQUEST_SLEEP)
+
+
+class NoAuthError(RuntimeError):
+    """Трекер ответил result=NoAuth — cookie больше не действует."""
+
+
+def http_get(
+    session: requests.Session,
+    url: str,
+    headers: Dict[str, str],
+    params: Any = None,
+) -> requests.Response:
+    # повторы (соединение, 429/5xx) делает Retry адаптера сессии, см. make_session
+    r = session.get(url, params=params, headers=headers, timeout=HTTP_TIMEOUT)
+    r.raise_for_status()
+    return r
+
+
+def fetch_track(
+    session: requests.Session,
+    oid: int,
+    dt_from: str,
+    dt_to: str,
+    raw_path: Optional[Path] = None,
+) -> Dict[str, Any]:
     """
     Реальный endpoint из твоего ноутбука:
       {BASE}/api/Api.svc/track?oid=...&from=...&to=...
     """
-    url = (
-        f"{BASE}/api/Api.svc/track"
-        f"?oid={oid}"
-        f"&from={quote(dt_from)}"
-        f"&to={quote(dt_to)}"
-    )
+    # строку запроса собирает urlencode; quote_via=quote — пробел как %20 (не "+"), как и раньше
+    params = urlencode({"oid": oid, "from": dt_from, "to": dt_to}, quote_via=quote)
 
     headers = {
         "Accept": "application/json, text/javascript, */*; q=0.01",
         "X-Requested-With": "XMLHttpRequest",
         "Referer": f"{BASE}/MileageReportData.aspx",
-        "Cookie": cookie_line,
-        "User-Agent": "Mozilla/5.0",
     }
-    r = http_get_retry(url, headers=headers)
+    r = http_get(session, f"{BASE}/api/Api.svc/track", headers=headers, params=params)
+    # вместо JSON может прийти HTML (логин/ошибка IIS) — не разбираем его, а говорим, что пришло
+    ctype = r.headers.get("Content-Type", "")
+    if "html" in ctype.lower():
+        raise RuntimeError(f"track oid={oid}: ожидали JSON, пришло {ctype}: {r.content[:200]!r}")
+    # отказ авторизации — короткий {"result":"NoAuth",...}: узнаём по байтам, без разбора JSON
+    if b"NoAuth" in r.content[:256]:
+        raise NoAuthError(f"track oid={oid}: NoAuth")
+    if raw_path is not None:
+        # сырой ответ сохраняем как пришёл, без повторной сериализации
+        raw_path.write_bytes(r.content)
+    if orjson is not None:
+        return orjson.loads(r.content)
     return r.json()
 
 
+def fetch_chunk(
+    session: requests.Session,
+    oid: int,
+    c_from: datetime,
+    c_to: datetime,
+    raw_dir: Optional[Path] = None,
+) -> Tuple[datetime, datetime, Dict[str, Any]]:
+    """
+    Скачивает один временной чанк (выполняется в пуле потоков).
+    raw_dir — куда сохранить сырой JSON ответа (--save-raw).
+    Возвращает (c_from, c_to, data).
+    """
+    c_from_s = fmt_dt(c_from)
+    c_to_s = fmt_dt(c_to)
+
+    if DEBUG:
+        log(f"[DEBUG] fetch oid={oid} {c_from_s} → {c_to_s}")
+
+    raw_path = None
+    if raw_dir is not None:
+        raw_path = raw_dir / f"track_{oid}_{c_from_s.replace(':','-')}_{c_to_s.replace(':','-')}.json"
+
+    _RATE.wait()
+    stale = _TLS.cookie_line
+    try:
+        data = fetch_track(session, oid, c_from_s, c_to_s, raw_path)
+    except NoAuthError:
+        # сессия протухла посреди загрузки: один перелогин (общий для всех потоков) и повтор;
+        # повторный NoAuth пробрасываем — иначе пустой чанк сдвинул бы last_dt
+        refresh_cookie_line(stale)
+        _RATE.wait()
+        data = fetch_track(thread_session(), oid, c_from_s, c_to_s, raw_path)
+    return c_from, c_to, data
+
+
 # =========================
 # MONGO
 # =========================
 
-mongo = MongoClient(MONGO_URI)
+def _mongo_compressors() -> str:
+    # zstd/snappy — только если установлены zstandard/python-snappy (иначе pymongo ругается),
+    # zlib есть всегда
+    out = []
+    try:
+        import zstandard  # type: ignore  # noqa: F401
+        out.append("zstd")
+    except Exception:
+        pass
+    try:
+        import snappy  # type: ignore  # noqa: F401
+        out.append("snappy")
+    except Exception:
+        pass
+    out.append("zlib")
+    return ",".join(out)
+
+
+# точки идемпотентны (уникальный (oid, tm)) — ждать сброса журнала на каждый батч незачем
+mongo = MongoClient(
+    MONGO_URI,
+    w=1,
+    journal=False,
+    retryWrites=True,
+    compressors=_mongo_compressors(),
+    maxPoolSize=MONGO_MAX_POOL,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+)
 db = mongo[DB_NAME]
 points_col = db[COL_POINTS]
 state_col = db[STATE_COL]
 
-# Уникальность по (oid, tm) — чтобы повторные загрузки не плодили дубликаты
-# (tm приходит из источника и стабилен)
-try:
-    points_col.create_index([("oid", ASCENDING), ("tm", ASCENDING)], unique=True, name="uniq_oid_tm")
-except Exception:
-    pass
+
+def ensure_indexes(require_unique: bool = True) -> None:
+    """
+    Индексы точек; вызывается один раз из main() до записи. Уже существующие — no-op,
+    ошибки (нет прав, конфликт опций) не валят загрузку — кроме uniq_oid_tm при
+    require_unique: вставки без него молча задвоят уже загруженные точки (RuntimeError).
+    """
+    specs = [
+        # Уникальность по (oid, tm) — чтобы повторные загрузки не плодили дубликаты
+        # (tm приходит из источника и стабилен); на нём же отсекаются дубликаты вставок
+        ([("oid", ASCENDING), ("tm", ASCENDING)], {"unique": True, "name": "uniq_oid_tm"}),
+        # tm_dt — то же время нативной датой: выборки по периоду и сортировка без разбора строк
+        ([("oid", ASCENDING), ("tm_dt", ASCENDING)], {"name": "oid_tm_dt"}),
+        # выборка точек одного запуска
+        ([("track_key", ASCENDING)], {"name": "track_key"}),
+    ]
+    for keys, opts in specs:
+        try:
+            points_col.create_index(keys, **opts)
+        except Exception as e:
+            if require_unique and opts.get("unique"):
+                raise RuntimeError(f"индекс {opts['name']} не создан: {e}") from e
+            log(f"[WARN] индекс {opts['name']} не создан: {e}")
+
+
+def migrate_tm_dt() -> int:
+    """
+    Разовая миграция: проставляет tm_dt старым документам из строки tm прямо на сервере.
+    Нераспознанное время становится null (повторно не обрабатывается).
+    """
+    res = points_col.update_many(
+        {"tm_dt": {"$exists": False}},
+        [
+            {
+                "$set": {
+                    "tm_dt": {
+                        "$dateFromString": {
+                            "dateString": "$tm",
+                            "format": "%Y-%m-%d %H:%M:%S",
+                            "onError": None,
+                        }
+                    }
+                }
+            }
+        ],
+    )
+    return res.modified_count
 
 
 def state_key_for_oid(oid: int) -> str:
@@ -343,16 +639,86 @@ def set_last_dt_for_oid(oid: int, dt: datetime) -> None:
     )
 
 
-@dataclass
-class ParsedPoint:
-    lat: float
-    lon: float
-    tm: str
-    speed: Optional[float]
-    st: Any
-    dir_: Any
-    dst: Any
-    width: Any
+# Разобранная точка — простой кортеж (lat, lon, tm, speed, st, dir, dst, width):
+# точек десятки тысяч на чанк, кортеж создаётся дешевле объекта,
+# а build_ops сразу распаковывает его в поля документа
+ParsedPoint = Tuple[float, float, str, Optional[float], Any, Any, Any, Any]
+
+
+def _parse_row(row: Any) -> Optional[ParsedPoint]:
+    # Медленный путь: произвольная строка (короткий список, dict, мусор)
+    if isinstance(row, list):
+        dir_ = row[0] if len(row) > 0 else None
+        dst = row[1] if len(row) > 1 else None
+        lat = _to_float(row[2] if len(row) > 2 else None)
+        lon = _to_float(row[3] if len(row) > 3 else None)
+        speed = _to_float(row[4] if len(row) > 4 else None)
+        st = row[5] if len(row) > 5 else None
+        tm = row[6] if len(row) > 6 else None
+        width = row[7] if len(row) > 7 else None
+    elif isinstance(row, dict):
+        dir_ = row.get("dir")
+        dst = row.get("dst")
+        lat = _to_float(row.get("lat"))
+        lon = _to_float(row.get("lon"))
+        speed = _to_float(row.get("speed"))
+        st = row.get("st")
+        tm = row.get("tm")
+        width = row.get("width")
+    else:
+        return None
+
+    if lat is None or lon is None or tm in (None, ""):
+        return None
+    return (lat, lon, str(tm), speed, st, dir_, dst, width)
+
+
+def _parse_list_rows(coords: List[Any]) -> List[ParsedPoint]:
+    out: List[ParsedPoint] = []
+    append = out.append
+    for row in coords:
+        # распаковка сама по себе не проверка: 8 элементов есть и у dict с 8 ключами,
+        # и у 8-символьной строки — поэтому сначала тип и длина
+        if type(row) is not list or len(row) != 8:
+            # строка другой длины/формы — разбираем по-старому
+            p = _parse_row(row)
+            if p is not None:
+                append(p)
+            continue
+        dir_, dst, lat, lon, speed, st, tm, width = row
+
+        # координаты почти всегда уже float — _to_float только для остального
+        if type(lat) is not float:
+            lat = _to_float(lat)
+        if type(lon) is not float:
+            lon = _to_float(lon)
+        if lat is None or lon is None or tm in (None, ""):
+            continue
+        if type(speed) is not float:
+            speed = _to_float(speed)
+        append((lat, lon, str(tm), speed, st, dir_, dst, width))
+    return out
+
+
+def _parse_dict_rows(coords: List[Any]) -> List[ParsedPoint]:
+    out: List[ParsedPoint] = []
+    append = out.append
+    for row in coords:
+        try:
+            get = row.get
+        except AttributeError:
+            p = _parse_row(row)
+            if p is not None:
+                append(p)
+            continue
+
+        lat = _to_float(get("lat"))
+        lon = _to_float(get("lon"))
+        tm = get("tm")
+        if lat is None or lon is None or tm in (None, ""):
+            continue
+        append((lat, lon, str(tm), _to_float(get("speed")), get("st"), get("dir"), get("dst"), get("width")))
+    return out
 
 
 def parse_coords(coords: Any) -> List[ParsedPoint]:
@@ -360,117 +726,228 @@ def parse_coords(coords: Any) -> List[ParsedPoint]:
     coords обычно list[list] формата:
       [dir, dst, lat, lon, speed, st, tm, width]
     либо list[dict]
+    Форма строк в пределах одного ответа одна — смотрим на первую и выбираем цикл один раз.
     """
-    out: List[ParsedPoint] = []
     if not coords:
-        return out
+        return []
 
-    for row in coords:
-        if isinstance(row, list):
-            dir_ = row[0] if len(row) > 0 else None
-            dst = row[1] if len(row) > 1 else None
-            lat = _to_float(row[2] if len(row) > 2 else None)
-            lon = _to_float(row[3] if len(row) > 3 else None)
-            speed = _to_float(row[4] if len(row) > 4 else None)
-            st = row[5] if len(row) > 5 else None
-            tm = row[6] if len(row) > 6 else None
-            width = row[7] if len(row) > 7 else None
-        elif isinstance(row, dict):
-            dir_ = row.get("dir")
-            dst = row.get("dst")
-            lat = _to_float(row.get("lat"))
-            lon = _to_float(row.get("lon"))
-            speed = _to_float(row.get("speed"))
-            st = row.get("st")
-            tm = row.get("tm")
-            width = row.get("width")
-        else:
-            continue
+    first = coords[0]
+    if isinstance(first, list):
+        return _parse_list_rows(coords)
+    if isinstance(first, dict):
+        return _parse_dict_rows(coords)
+    return [p for p in map(_parse_row, coords) if p is not None]
 
-        if lat is None or lon is None or tm in (None, ""):
-            continue
 
-        out.append(
-            ParsedPoint(
-                lat=float(lat),
-                lon=float(lon),
-                tm=str(tm),
-                speed=speed,
-                st=st,
-                dir_=dir_,
-                dst=dst,
-                width=width,
-            )
-        )
-    return out
+# операция записи точки: InsertOne (по умолчанию) или UpdateOne (--upsert)
+WriteOp = Union[InsertOne, UpdateOne]
 
 
 def build_ops(
     oid: int,
     run_from: str,
     run_to: str,
-    src_from: str,
-    src_to: str,
+    src_from: datetime,
+    src_to: datetime,
     pts: List[ParsedPoint],
-) -> List[UpdateOne]:
+    now: datetime,
+    upsert: bool = False,
+) -> Iterator[WriteOp]:
     """
-    Upsert по (oid, tm) — стабильно между перезапусками.
+    По умолчанию — вставка: точки по (oid, tm) не меняются, уже загруженные отсекает
+    уникальный индекс (дубликаты bulk_write_safe пропускает). upsert=True — UpdateOne
+    с upsert по (oid, tm), перезаписывает поля уже загруженных точек.
     track_key общий для всего запуска (run_from/run_to), чтобы удобно фильтровать.
+    Операции отдаются лениво — bulk_write_safe забирает их порциями.
+    now — время запуска (created_at/updated_at), одно на все чанки и oid.
     """
-    now = now_utc()
+    oid_i = int(oid)
     track_key = f"{oid}|{run_from}|{run_to}"
 
-    ops: List[UpdateOne] = []
-    for idx, p in enumerate(pts):
+    # всё, что не зависит от точки, собираем один раз (порядок полей в документе прежний)
+    head = {"track_key": track_key, "oid": oid_i}
+    tail = {
+        # окна источника (чанк) — нативные даты: 8 байт в BSON против строки, сравниваются по периоду
+        "src_window_from": src_from,
+        "src_window_to": src_to,
+        "updated_at": now,
+    }
+    on_insert = {"created_at": now}
+
+    for lat, lon, tm, speed, st, dir_, dst, width in pts:
+        try:
+            tm_dt: Optional[datetime] = parse_dt(tm)
+        except ValueError:
+            tm_dt = None
         doc_set = {
-            "track_key": track_key,
-            "oid": int(oid),
-            "tm": p.tm,
-            "lat": p.lat,
-            "lon": p.lon,
-            "speed": p.speed,
-            "st": p.st,
-            "dir": p.dir_,
-            "dst": p.dst,
-            "width": p.width,
-            # окна источника (чанк)
-            "src_window_from": src_from,
-            "src_window_to": src_to,
-            "updated_at": now,
+            **head,
+            "tm": tm,
+            "tm_dt": tm_dt,
+            "lat": lat,
+            "lon": lon,
+            "speed": speed,
+            "st": st,
+            "dir": dir_,
+            "dst": dst,
+            "width": width,
+            **tail,
         }
-        ops.append(
-            UpdateOne(
-                {"oid": int(oid), "tm": p.tm},
-                {"$set": doc_set, "$setOnInsert": {"created_at": now}},
+        if upsert:
+            yield UpdateOne(
+                {"oid": oid_i, "tm": tm},
+                {"$set": doc_set, "$setOnInsert": on_insert},
                 upsert=True,
             )
-        )
-    return ops
+        else:
+            doc_set.update(on_insert)
+            yield InsertOne(doc_set)
 
 
-def bulk_write_safe(ops: List[UpdateOne]) -> Tuple[int, int, int]:
-    if not ops:
-        return (0, 0, 0)
-    try:
-        res = points_col.bulk_write(ops, ordered=False)
-        upserted = len(res.upserted_ids) if res.upserted_ids else 0
-        return (res.matched_count, res.modified_count, upserted)
-    except BulkWriteError as e:
-        # возможны дубликаты tm, если источник отдаёт повторения в стыке чанков
-        if DEBUG:
-            print("[WARN] BulkWriteError (trim):", str(e.details)[:1200])
-        details = e.details or {}
-        return (
-            int(details.get("nMatched", 0)),
-            int(details.get("nModified", 0)),
-            int(details.get("nUpserted", 0)),
-        )
+# код ошибки уникального индекса: та же (oid, tm) уже записана — повторять нечего
+DUP_KEY_ERROR = 11000
+
+
+def _bulk_write_slab(ops: List[WriteOp]) -> Tuple[int, int, int]:
+    matched = modified = upserted = 0
+    attempts = max(1, BULK_ATTEMPTS)
+    for attempt in range(attempts):
+        try:
+            res = points_col.bulk_write(ops, ordered=False, bypass_document_validation=True)
+            upserted += res.upserted_count + res.inserted_count
+            return (matched + res.matched_count, modified + res.modified_count, upserted)
+        except BulkWriteError as e:
+            # дубликаты (oid, tm): точка уже загружена или источник повторил её в стыке чанков
+            if DEBUG:
+                log(f"[WARN] BulkWriteError (trim): {str(e.details)[:1200]}")
+            details = e.details or {}
+            matched += int(details.get("nMatched", 0))
+            modified += int(details.get("nModified", 0))
+            upserted += int(details.get("nUpserted", 0)) + int(details.get("nInserted", 0))
+
+            # ordered=False: index указывает на операцию в ops, остальные уже применены
+            failed = [
+                ops[we["index"]]
+                for we in details.get("writeErrors", [])
+                if we.get("code") != DUP_KEY_ERROR
+            ]
+            if not failed:
+                break
+            ops = failed
+            # пауза только перед следующей попыткой — после последней сразу к предупреждению
+            if attempt + 1 < attempts:
+                time.sleep(HTTP_RETRY_SLEEP * (attempt + 1))
+    else:
+        log(f"[WARN] не записано операций после {BULK_ATTEMPTS} попыток: {len(ops)}")
+    return (matched, modified, upserted)
+
+
+def bulk_write_safe(ops: Iterable[WriteOp]) -> Tuple[int, int, int]:
+    """
+    Пишет ops порциями по BULK_SLAB, чтобы не собирать огромный батч в памяти.
+    Возвращает суммарные (matched, modified, upserted); upserted — все новые документы,
+    вставленные и через upsert.
+    """
+    matched = modified = upserted = 0
+    it = iter(ops)
+    while True:
+        slab = list(islice(it, BULK_SLAB))
+        if not slab:
+            break
+        m, md, u = _bulk_write_slab(slab)
+        matched += m
+        modified += md
+        upserted += u
+    return (matched, modified, upserted)
 
 
 # =========================
 # MAIN
 # =========================
 
+def map_window(ex: ThreadPoolExecutor, fn: Callable[[Any], Any], items: Iterable[Any], window: int) -> Iterator[Any]:
+    """
+    Как ex.map (результаты по порядку), но в работе и в ожидании не больше window задач:
+    ex.map ставит в очередь сразу все и держит готовые ответы, пока их не заберут,
+    так что при медленной записи в Mongo скачанные JSON копятся в памяти.
+    """
+    it = iter(items)
+    pending: Deque[Future] = deque(ex.submit(fn, x) for x in islice(it, max(1, window)))
+    try:
+        while pending:
+            fut = pending.popleft()
+            for x in islice(it, 1):
+                pending.append(ex.submit(fn, x))
+            yield fut.result()
+    finally:
+        # ошибка/остановка посреди oid — невзятые задачи не качаем
+        for fut in pending:
+            fut.cancel()
+
+
+def run_oid(
+    oid: int,
+    args: argparse.Namespace,
+    forced_from: Optional[datetime],
+    forced_to: Optional[datetime],
+    raw_dir: Path,
+    now: datetime,
+    fetch_ex: ThreadPoolExecutor,
+) -> Tuple[int, int, int, int]:
+    """
+    Загружает период одного oid и сдвигает его last_dt.
+    Возвращает (points, matched, modified, upserted).
+    """
+    # определяем период для oid
+    if args.reset_state:
+        dt_from = forced_from or start_of_month_local()
+    else:
+        dt_from = forced_from or get_last_dt_for_oid(oid)
+
+    dt_to = forced_to or datetime.now().replace(microsecond=0)
+
+    run_from = fmt_dt(dt_from)
+    run_to = fmt_dt(dt_to)
+
+    log(f"\n=== OID {oid} ===\nPERIOD: {run_from} → {run_to} | chunk_hours={args.chunk_hours}")
+
+    chunks = iter_chunks(dt_from, dt_to, args.chunk_hours)
+    cnt_oid = 0
+
+    # cookie может протухнуть между oid — проверяем мягко перед пачкой запросов
+    check_cookie_line()
+
+    def iter_oid_ops(fetched: Iterable[Tuple[datetime, datetime, Dict[str, Any]]]) -> Iterator[WriteOp]:
+        nonlocal cnt_oid
+        for c_from, c_to, data in fetched:
+            coords = data.get("coords", [])
+            pts = parse_coords(coords)
+            cnt_oid += len(pts)
+
+            if DEBUG:
+                log(f"[DEBUG] coords_len={len(coords)} parsed_pts={len(pts)} result={data.get('result')}")
+
+            if pts:
+                yield from build_ops(oid, run_from, run_to, c_from, c_to, pts, now, args.upsert)
+
+    # сеть — параллельно в общем пуле fetch_ex, разбор и запись в Mongo — здесь, по порядку чанков.
+    # Вперёд качается не больше 2*FETCH_WORKERS чанков (скачанные, но не записанные ответы
+    # лежат в памяти), операции идут в bulk_write_safe потоком порциями по BULK_SLAB
+    save_dir = raw_dir if args.save_raw else None
+    fetched = map_window(
+        fetch_ex,
+        lambda ch: fetch_chunk(thread_session(), oid, ch[0], ch[1], save_dir),
+        chunks,
+        2 * max(1, FETCH_WORKERS),
+    )
+    total_matched, total_modified, total_upserted = bulk_write_safe(iter_oid_ops(fetched))
+
+    # сдвигаем last_dt для oid
+    set_last_dt_for_oid(oid, dt_to)
+
+    log(f"OID {oid}: points={cnt_oid}")
+    return cnt_oid, total_matched, total_modified, total_upserted
+
+
 def main() -> int:
     ap = argparse.ArgumentParser()
     ap.add_argument("--oids", default="", help="Список oid через запятую (перекрывает ENV OIDS)")
@@ -479,13 +956,26 @@ def main() -> int:
     ap.add_argument("--reset-state", action="store_true", help="Сбросить sync_state и загрузить заново")
     ap.add_argument("--chunk-hours", type=int, default=DEFAULT_CHUNK_HOURS, help="Размер чанка в часах")
     ap.add_argument("--save-raw", action="store_true", help="Сохранять JSON-ответы в ./tracks_raw/")
+    ap.add_argument("--upsert", action="store_true", help="Перезаписывать уже загруженные точки (иначе только вставка новых)")
+    ap.add_argument("--migrate-tm-dt", action="store_true", help="Проставить tm_dt старым точкам и выйти")
     args = ap.parse_args()
 
+    if args.migrate_tm_dt:
+        print(f"✅ tm_dt проставлено: {migrate_tm_dt()}")
+        return 0
+
     oids = parse_oids(args.oids) if args.oids.strip() else parse_oids(OIDS_ENV)
     if not oids:
         print("❌ Нет OID. Укажи ENV OIDS='182,716' или --oids '182,716'")
         return 2
 
+    # без --upsert точки только вставляются — дубликаты отсекает лишь уникальный индекс
+    try:
+        ensure_indexes(require_unique=not args.upsert)
+    except RuntimeError as e:
+        print(f"❌ {e} — без него вставка задвоит точки (или запусти с --upsert)")
+        return 2
+
     forced_from = parse_dt(args.dt_from) if args.dt_from else None
     forced_to = parse_dt(args.dt_to) if args.dt_to else None
 
@@ -494,9 +984,9 @@ def main() -> int:
         return 2
 
     # Подготовка HTTP / cookie
-    session = requests.Session()
-    cookie_line = load_cookie_line()
-    cookie_line = ensure_cookie_line(session, cookie_line)
+    global _COOKIE_LINE
+    _COOKIE_LINE = load_cookie_line()
+    check_cookie_line()
     print(f"✅ Cookie готовы: {COOKIE_PATH}")
 
     # Опционально папка raw
@@ -509,79 +999,25 @@ def main() -> int:
     total_matched = 0
     total_modified = 0
     per_oid: Dict[int, int] = {}
-
-    for oid in oids:
-        # определяем период для oid
-        if args.reset_state:
-            dt_from = forced_from or start_of_month_local()
-        else:
-            dt_from = forced_from or get_last_dt_for_oid(oid)
-
-        dt_to = forced_to or datetime.now().replace(microsecond=0)
-
-        run_from = fmt_dt(dt_from)
-        run_to = fmt_dt(dt_to)
-
-        print(f"\n=== OID {oid} ===")
-        print(f"PERIOD: {run_from} → {run_to} | chunk_hours={args.chunk_hours}")
-
-        chunks = iter_chunks(dt_from, dt_to, args.chunk_hours)
-        ops_buf: List[UpdateOne] = []
-        BUF_LIMIT = 5000
-        cnt_oid = 0
-
-        for (c_from, c_to) in chunks:
-            c_from_s = fmt_dt(c_from)
-            c_to_s = fmt_dt(c_to)
-
-            # cookie может протухнуть в процессе — проверяем мягко
-            cookie_line = ensure_cookie_line(session, cookie_line)
-
-            if DEBUG:
-                print(f"[DEBUG] fetch oid={oid} {c_from_s} → {c_to_s}")
-
-            data = fetch_track(cookie_line, oid, c_from_s, c_to_s)
-
-            if args.save_raw:
-                (raw_dir / f"track_{oid}_{c_from_s.replace(':','-')}_{c_to_s.replace(':','-')}.json").write_text(
-                    json.dumps(data, ensure_ascii=False),
-                    encoding="utf-8",
-                )
-
-            coords = data.get("coords", [])
-            pts = parse_coords(coords)
-            cnt_oid += len(pts)
-            total_pts += len(pts)
-
-            if DEBUG:
-                print(f"[DEBUG] coords_len={len(coords)} parsed_pts={len(pts)} result={data.get('result')}")
-
-            if pts:
-                ops_buf.extend(build_ops(oid, run_from, run_to, c_from_s, c_to_s, pts))
-
-            if len(ops_buf) >= BUF_LIMIT:
-                matched, modified, upserted = bulk_write_safe(ops_buf)
-                total_matched += matched
-                total_modified += modified
-                total_upserted += upserted
-                ops_buf.clear()
-
-            if REQUEST_SLEEP > 0:
-                time.sleep(REQUEST_SLEEP)
-
-        # финальный flush
-        if ops_buf:
-            matched, modified, upserted = bulk_write_safe(ops_buf)
+    # метка времени записи — одна на запуск
+    run_now = now_utc()
+
+    oid_workers = max(1, min(len(oids), OID_WORKERS))
+    # пул загрузки один на запуск: потоки живут между oid, а с ними и их сессии
+    # с открытыми keep-alive соединениями (новый пул на каждый oid заново делал TCP-хендшейки)
+    fetch_ex = ThreadPoolExecutor(max_workers=max(1, FETCH_WORKERS) * oid_workers)
+
+    def _run(oid: int) -> Tuple[int, int, int, int]:
+        return run_oid(oid, args, forced_from, forced_to, raw_dir, run_now, fetch_ex)
+
+    # oid независимы (своё состояние, свои документы) — обрабатываем параллельно
+    with fetch_ex, ThreadPoolExecutor(max_workers=oid_workers) as ex:
+        for oid, (cnt_oid, matched, modified, upserted) in zip(oids, ex.map(_run, oids)):
+            per_oid[oid] = cnt_oid
+            total_pts += cnt_oid
             total_matched += matched
             total_modified += modified
             total_upserted += upserted
-            ops_buf.clear()
-
-        per_oid[oid] = cnt_oid
-        # сдвигаем last_dt для oid
-        set_last_dt_for_oid(oid, dt_to)
-
-        print(f"OID {oid}: points={cnt_oid}")
 
     print("\n=== DONE ===")
     print("points per oid:", per_oid)
@@ -71,6 +71,15 @@ function normalizeLatLngsFromTrip(trip){
     if (ll.length) return ll;
   }
 
+  // trip.points: {lat:[...], lon:[...], tm:[...]} (колонками, как отдаёт /api/trips_for_map)
+  if (Array.isArray(trip?.points?.lat) && Array.isArray(trip?.points?.lon)){
+    const lon = trip.points.lon;
+    const ll = trip.points.lat
+      .map((lat, k) => [Number(lat), Number(lon[k])])
+      .filter(p => Number.isFinite(p[0]) && Number.isFinite(p[1]));
+    if (ll.length) return ll;
+  }
+
   // trip.points: [{lat,lon}, ...]
   if (Array.isArray(trip?.points) && trip.points.length){
     const ll = trip.points